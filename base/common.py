@@ -4,16 +4,100 @@
 common.py
 gerhard van andel
 """
+import os
+import re
+import sys
+import math
+import json
+import time
+import random
 import logging
 import socket
 import redis
+import pika
 import hashlib
-from time import sleep
 from datetime import datetime
+from itertools import combinations
+from collections import Counter
 from urllib.parse import urlparse
 
 
 USER_BUCKET = 'term-project'
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
+RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+# when set blobs are kept on the local disk instead of google cloud storage
+BLOB_DIR = os.environ.get('BLOB_DIR')
+READY_TIMEOUT = float(os.environ.get('READY_TIMEOUT', 60))
+READY_MAX_DELAY = 2.0
+# 10 matches the spider's default crawl delay (USER_DELAY)
+RETRY_DELAYS = (1, 5, 10, 30, 120)
+MAX_RETRIES = 8
+RETRY_HEADER = 'x-retry-count'
+# spider tasks go through a consistent hash exchange (rabbitmq_consistent_hash_exchange
+# plugin) on the domain header, so a domain always lands on the same shard queue
+SPIDER_EXCHANGE = 'spider_exchange'
+SPIDER_SHARDS = int(os.environ.get('SPIDER_SHARDS', 16))
+DOMAIN_HEADER = 'domain'
+SIMHASH_BITS = 64
+# pages within this many differing bits are near duplicates, a near duplicate
+# always matches SIMHASH_BANDS - SIMHASH_DISTANCE bands exactly so the index is
+# keyed on every combination of that many bands (28 keys of 16 bits)
+SIMHASH_DISTANCE = 6
+SIMHASH_BANDS = 8
+# pages with fewer distinct words are too short to fingerprint, they are only
+# matched on their exact content hash
+SIMHASH_MIN_WORDS = 32
+SIMHASH_LINK_WEIGHT = 4
+
+_redis_clients = dict()
+_storage_client = None
+
+
+class BlobNotFound(Exception):
+    """
+    The blob does not exist in the bucket
+    """
+
+
+def process_uptime():
+    """
+    Wall clock seconds since this process started, linux only
+    """
+    try:
+        with open('/proc/self/stat') as stat:
+            # the command name can hold spaces, the fields after it start at state
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime:
+            system_uptime = float(uptime.read().split()[0])
+        return max(0.0, system_uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class StartupTimer:
+    """
+    Records how long each startup phase of a service took
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.start = self.last = time.monotonic()
+        # wall clock time since the process started is the interpreter start
+        # and the module imports
+        uptime = process_uptime()
+        self.phases = [('imports', uptime)] if uptime is not None else list()
+
+    def mark(self, phase: str):
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(x[1] for x in self.phases)
+        breakdown = ', '.join(f'{phase} {seconds:.3f}' for phase, seconds in self.phases)
+        self.logger.info(f' [*] startup time took, {total:.3f} seconds ({breakdown})')
 
 
 def setup_logger(name: str) -> logging.Logger:
@@ -30,24 +114,28 @@ def setup_logger(name: str) -> logging.Logger:
     return logger
 
 
-def wait_for_connection(logger: logging.Logger):
-    ping_counter = 1
-    is_reachable = False
-    start_time = datetime.utcnow()
-    while is_reachable is False and ping_counter < 10:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def wait_for_connection(logger: logging.Logger, timeout: float = READY_TIMEOUT):
+    """
+    Probe the broker with short jittered backoff until it accepts connections
+    """
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    attempt = 0
+    while True:
         try:
-            sock.connect(('rabbitmq', 5672))
-            is_reachable = True
-        except socket.error as e:
-            logger.error(f' [*] failed to connect, retry in {ping_counter ** 2} seconds')
-            sleep(ping_counter ** 2)
-            ping_counter += 1
-        sock.close()
-    elapsed = (datetime.utcnow() - start_time).total_seconds()
-    if is_reachable:
-        logger.info(f' [*] connected, startup time took {elapsed} seconds')
-    return is_reachable
+            with socket.create_connection((RABBITMQ_HOST, RABBITMQ_PORT), timeout=1):
+                break
+        except OSError as err:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.error(f' [*] failed to connect after {attempt + 1} attempts, {err}')
+                return False
+            delay = min(remaining, random.uniform(0, min(READY_MAX_DELAY, 0.05 * 2 ** attempt)))
+            logger.info(f' [*] broker not ready, retry in {delay:.3f} seconds')
+            time.sleep(delay)
+            attempt += 1
+    logger.info(f' [*] connected after {attempt} retries, {time.monotonic() - start_time:.3f} seconds')
+    return True
 
 
 def make_spider_task(input_url: str, depth: int = 1):
@@ -69,17 +157,272 @@ def make_spider_task(input_url: str, depth: int = 1):
     }
 
 
+def get_rabbitmq_connection():
+    credentials = pika.PlainCredentials('guest', 'guest')
+    return pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials))
+
+
+def get_storage_client():
+    """
+    The google cloud storage client, the sdk is only imported on first use
+    """
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+def upload_blob(bucket_name, source_data, destination_blob_name, content_type):
+    """
+    Uploads data to the bucket, or under BLOB_DIR when it is set
+    """
+    if BLOB_DIR:
+        path = os.path.join(BLOB_DIR, bucket_name, destination_blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(source_data, str):
+            source_data = source_data.encode('utf-8')
+        with open(f'{path}.tmp', 'wb') as blob_file:
+            blob_file.write(source_data)
+        os.replace(f'{path}.tmp', path)
+        return
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(destination_blob_name)
+    blob.upload_from_string(source_data, content_type=content_type)
+
+
+def download_blob(bucket_name, blob_name):
+    """
+    Downloads a blob from the bucket, or from under BLOB_DIR when it is set
+    """
+    if BLOB_DIR:
+        try:
+            with open(os.path.join(BLOB_DIR, bucket_name, blob_name), 'rb') as blob_file:
+                return blob_file.read()
+        except FileNotFoundError as err:
+            raise BlobNotFound(f'{bucket_name}/{blob_name}') from err
+    from google.cloud.exceptions import NotFound
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(blob_name)
+    try:
+        return blob.download_as_string()
+    except NotFound as err:
+        raise BlobNotFound(f'{bucket_name}/{blob_name}') from err
+
+
+def is_transient_error(err) -> bool:
+    """
+    Connection problems and server side failures worth retrying, library
+    exceptions are only checked when the library has been loaded
+    """
+    requests_exceptions = sys.modules.get('requests.exceptions')
+    if requests_exceptions is not None:
+        if isinstance(err, (requests_exceptions.ConnectionError, requests_exceptions.Timeout)):
+            return True
+        if isinstance(err, requests_exceptions.HTTPError) and err.response is not None:
+            return err.response.status_code >= 500 or err.response.status_code == 429
+    process_pool = sys.modules.get('concurrent.futures.process')
+    if process_pool is not None and isinstance(err, process_pool.BrokenProcessPool):
+        return True
+    google_exceptions = sys.modules.get('google.api_core.exceptions')
+    if google_exceptions is not None:
+        if isinstance(err, (google_exceptions.ServerError, google_exceptions.TooManyRequests)):
+            return True
+    return isinstance(err, (ConnectionError, TimeoutError))
+
+
+def get_redis(db: int):
+    """
+    One client per database for the process, the client keeps a connection
+    pool that is thread safe and is reset by redis-py after a fork
+    """
+    client = _redis_clients.get(db)
+    if client is None:
+        client = _redis_clients.setdefault(db, redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=db))
+    return client
+
+
 def get_stats_redis():
-    return redis.StrictRedis(host='redis', port=6379, db=3)
+    return get_redis(3)
 
 
 def get_domain_redis():
-    return redis.StrictRedis(host='redis', port=6379, db=2)
+    return get_redis(2)
 
 
 def get_job_redis():
-    return redis.StrictRedis(host='redis', port=6379, db=1)
+    return get_redis(1)
+
+
+def get_fingerprint_redis():
+    return get_redis(4)
+
+
+def get_fetch_redis():
+    return get_redis(5)
+
+
+def get_fetch_record(url):
+    """
+    What is known about the last fetch of a url: etag, last modified, content
+    hashes, fetch time, blob location and the parse result once scanned
+    """
+    record = get_fetch_redis().get(url)
+    return json.loads(record) if record is not None else None
+
+
+def set_fetch_record(url, record):
+    get_fetch_redis().set(url, json.dumps(record))
 
 
 def domain_hash(correlation, url):
     return hashlib.sha256('{}:{}'.format(correlation, url).encode('utf-8')).hexdigest()
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def simhash(text: str):
+    """
+    SimHash of the words and link targets of a page, pages that share most of
+    their words and links end up a few bits apart, None for short pages
+    """
+    hrefs = Counter(re.findall(r'<a\s[^>]*href\s*=\s*["\']?([^"\'\s>]+)', text, re.IGNORECASE))
+    words = Counter(re.findall(r'\w+', re.sub(r'<[^>]*>', ' ', text).lower()))
+    if len(words) < SIMHASH_MIN_WORDS:
+        return None
+    # damped counts so a few common words can not outweigh the rest of the page
+    features = [(f'word:{w}', 1 + math.log(n)) for w, n in words.items()]
+    features += [(f'href:{h}', SIMHASH_LINK_WEIGHT) for h in hrefs]
+    features = [(int.from_bytes(hashlib.blake2b(f.encode('utf-8'), digest_size=8).digest(), 'big'), n)
+                for f, n in features]
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        mask = 1 << bit
+        if sum(n if h & mask else -n for h, n in features) > 0:
+            value |= mask
+    return value
+
+
+def simhash_bands(value: int):
+    """
+    Index keys of a simhash, one for every combination of the bands a near
+    duplicate is sure to share
+    """
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    bands = [(value >> (band * width)) & ((1 << width) - 1) for band in range(SIMHASH_BANDS)]
+    return ['-'.join(f'{b}:{bands[b]:x}' for b in combination)
+            for combination in combinations(range(SIMHASH_BANDS), SIMHASH_BANDS - SIMHASH_DISTANCE)]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def retry_queue_name(queue: str, delay: int) -> str:
+    return f'{queue}.retry.{delay}s'
+
+
+def declare_retry_queues(channel, queue: str, exchange: str = ''):
+    """
+    Declare the tiered delay queues for a work queue, each tier holds a message
+    for its ttl and then dead letters it back onto the work queue, or into the
+    exchange with its original routing when one is given
+    """
+    for delay in RETRY_DELAYS:
+        arguments = {'x-message-ttl': delay * 1000, 'x-dead-letter-exchange': exchange}
+        if not exchange:
+            arguments['x-dead-letter-routing-key'] = queue
+        channel.queue_declare(queue=retry_queue_name(queue, delay), durable=True, arguments=arguments)
+
+
+def spider_shard_queue(shard: int) -> str:
+    return f'spider_queue.{shard}'
+
+
+def spider_shard_queues():
+    return [spider_shard_queue(x) for x in range(SPIDER_SHARDS)]
+
+
+def declare_spider_exchange(channel):
+    """
+    Declare the spider exchange, its shard queues and their delay queues
+    """
+    channel.exchange_declare(
+        exchange=SPIDER_EXCHANGE,
+        exchange_type='x-consistent-hash',
+        durable=True,
+        arguments={'hash-header': DOMAIN_HEADER}
+    )
+    for queue in spider_shard_queues():
+        channel.queue_declare(queue=queue, durable=True)
+        # the routing key of a binding is its weight on the hash ring
+        channel.queue_bind(queue=queue, exchange=SPIDER_EXCHANGE, routing_key='1')
+    declare_retry_queues(channel, SPIDER_EXCHANGE, SPIDER_EXCHANGE)
+
+
+def publish_spider_task(channel, message, domain: str, headers: dict = None):
+    channel.basic_publish(
+        exchange=SPIDER_EXCHANGE,
+        routing_key='',
+        properties=pika.BasicProperties(
+            content_type='application/json',
+            content_encoding='UTF-8',
+            delivery_mode=2,
+            headers=dict(headers or {}, **{DOMAIN_HEADER: domain})
+        ),
+        body=message,
+    )
+
+
+def shard_owner(shard: int, members):
+    """
+    Rendezvous hashing, the member with the highest score owns the shard so a
+    member joining or leaving only moves the shards it wins or held
+    """
+    return max(members, key=lambda m: hashlib.sha256(f'{m}:{shard}'.encode('utf-8')).digest())
+
+
+def owned_shards(member: str, members):
+    return [x for x in range(SPIDER_SHARDS) if members and shard_owner(x, members) == member]
+
+
+def get_retry_count(properties) -> int:
+    headers = properties.headers if properties is not None and properties.headers else {}
+    return int(headers.get(RETRY_HEADER, 0))
+
+
+def publish_delayed(channel, queue: str, body, delay: float, headers: dict = None):
+    """
+    Publish a message to the largest delay tier that does not overshoot the
+    delay, a message that comes back early is simply delayed again
+    """
+    tier = max((x for x in RETRY_DELAYS if x <= delay), default=RETRY_DELAYS[0])
+    channel.basic_publish(
+        exchange='',
+        routing_key=retry_queue_name(queue, tier),
+        properties=pika.BasicProperties(
+            content_type='application/json',
+            content_encoding='UTF-8',
+            delivery_mode=2,
+            headers=headers
+        ),
+        body=body,
+    )
+    return tier
+
+
+def publish_retry(channel, queue: str, body, properties) -> bool:
+    """
+    Send a message back to the queue through the delay tiers, returns False
+    once the message has used up its retries
+    """
+    retries = get_retry_count(properties)
+    if retries >= MAX_RETRIES:
+        return False
+    headers = dict(properties.headers) if properties is not None and properties.headers else {}
+    headers[RETRY_HEADER] = retries + 1
+    delay = RETRY_DELAYS[min(retries, len(RETRY_DELAYS) - 1)]
+    publish_delayed(channel, queue, body, delay, headers)
+    return True
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+benchmark.py
+runs controller, spider, scanner and cleaner against a synthetic web site
+on local redis and rabbitmq, then reports pages/sec, stage latencies and memory
+"""
+import os
+import sys
+import math
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'base'))
+
+import synthetic  # noqa: E402
+
+SERVICES = {
+    'controller': 'controller/controller.py',
+    'spider': 'spider/spider.py',
+    'scanner': 'scanner/scanner.py',
+    'cleaner': 'cleaner/cleaner.py',
+}
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a list of values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def peak_rss_kb(pid):
+    """
+    Peak resident memory of a process, linux only
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """
+    Direct children of a process, linux only
+    """
+    children = list()
+    try:
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(x) for x in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def tree_peak_rss_kb(pid):
+    """
+    Peak resident memory of a process and all of its descendants (parse
+    processes, gunicorn workers), pages shared after a fork are counted once
+    per process
+    """
+    total = peak_rss_kb(pid)
+    if total is None:
+        return None
+    for child in child_pids(pid):
+        total += tree_peak_rss_kb(child) or 0
+    return total
+
+
+def start_services(args, env, log_dir):
+    processes = list()
+    counts = {'controller': 1, 'spider': args.spiders, 'scanner': args.scanners, 'cleaner': args.cleaners}
+    for role, count in counts.items():
+        for n in range(count):
+            log = open(os.path.join(log_dir, f'{role}-{n}.log'), 'wb')
+            process = subprocess.Popen([sys.executable, os.path.join(ROOT, SERVICES[role])],
+                                       env=env, stdout=log, stderr=subprocess.STDOUT)
+            processes.append((role, process, log))
+    return processes
+
+
+def stop_services(processes):
+    memory = dict()
+    for role, process, log in processes:
+        memory.setdefault(role, list()).append(tree_peak_rss_kb(process.pid))
+        process.terminate()
+    for role, process, log in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+    return memory
+
+
+def wait_for_controller(controller, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{controller}/api/queues', timeout=2).status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.25)
+    return False
+
+
+def queue_depths(channel):
+    import common
+    names = common.spider_shard_queues() + ['scan_queue', 'cleanup_queue']
+    for queue in (common.SPIDER_EXCHANGE, 'scan_queue'):
+        names += [common.retry_queue_name(queue, x) for x in common.RETRY_DELAYS]
+    return {name: channel.queue_declare(queue=name, passive=True).method.message_count for name in names}
+
+
+def wait_for_drain(timeout, settle):
+    """
+    Wait until every queue has been empty for settle seconds
+    """
+    import common
+    connection = common.get_rabbitmq_connection()
+    channel = connection.channel()
+    common.declare_spider_exchange(channel)
+    for queue in ('scan_queue', 'cleanup_queue'):
+        channel.queue_declare(queue=queue, durable=True)
+    common.declare_retry_queues(channel, 'scan_queue')
+    deadline = time.time() + timeout
+    empty_since = None
+    try:
+        while time.time() < deadline:
+            total = sum(queue_depths(channel).values())
+            if total:
+                empty_since = None
+            elif empty_since is None:
+                empty_since = time.time()
+            elif time.time() - empty_since >= settle:
+                return True
+            connection.sleep(0.5)
+    finally:
+        connection.close()
+    return False
+
+
+def parse_timestamp(value):
+    return datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+def collect(correlation, blob_dir):
+    """
+    Read the records of a crawl, finished ones from the blob directory and
+    unfinished ones (failed, limited) still in the job database
+    """
+    import common
+    records = list()
+    data_dir = os.path.join(blob_dir, common.USER_BUCKET, 'data')
+    for name in os.listdir(data_dir) if os.path.isdir(data_dir) else list():
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(data_dir, name)
+        with open(path) as record_file:
+            record = json.load(record_file)
+        if record.get('correlation') == correlation:
+            record['completed'] = os.path.getmtime(path)
+            records.append(record)
+    r = common.get_job_redis()
+    for key in r.scan_iter(count=1000):
+        value = r.get(key)
+        if value is None:
+            continue
+        record = json.loads(value)
+        if record.get('correlation') == correlation:
+            records.append(record)
+    return records
+
+
+def stage_latencies(records):
+    stages = {'spider_wait': list(), 'fetch': list(), 'spider_to_scanned': list(),
+              'cleanup': list(), 'end_to_end': list()}
+    for record in records:
+        entries = record['data']
+        task = next((x for x in entries if x['type'] == 'spider'), None)
+        crawled = next((x for x in entries if x['type'] == 'scan' and 'code' in x), None)
+        scanned = next((x for x in entries if x['type'] == 'scan' and 'data' in x), None)
+        if task is None or crawled is None:
+            continue
+        queued = parse_timestamp(task['timestamp'])
+        started = parse_timestamp(crawled['timestamp'])
+        stages['spider_wait'].append(started - queued)
+        stages['fetch'].append(crawled['time'])
+        if scanned is not None:
+            stages['spider_to_scanned'].append(parse_timestamp(scanned['timestamp']) - started)
+            if 'completed' in record:
+                stages['cleanup'].append(record['completed'] - parse_timestamp(scanned['timestamp']))
+                stages['end_to_end'].append(record['completed'] - queued)
+    return {name: summarize(values) for name, values in stages.items()}
+
+
+def report(args, site, records, started, finished, memory, drained):
+    statuses = dict()
+    for record in records:
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+    pages = sum(1 for r in records if any(x['type'] == 'scan' and 'code' in x for x in r['data']))
+    elapsed = finished - started
+    return {
+        'site': {'pages': site.pages, 'links': args.links, 'hosts': site.hosts, 'page_size': site.page_size,
+                 'latency': site.latency, 'error_rate': site.error_rate, 'requests': site.requests,
+                 'errors': site.errors},
+        'workers': {'spider': args.spiders, 'scanner': args.scanners, 'cleaner': args.cleaners,
+                    'scanner_processes': args.scanner_processes},
+        'drained': drained,
+        'elapsed': elapsed,
+        'pages': pages,
+        'pages_per_second': pages / elapsed if elapsed > 0 else None,
+        'statuses': statuses,
+        'stages': stage_latencies(records),
+        'memory_kb': {role: summarize([x for x in values if x is not None]) for role, values in memory.items()},
+    }
+
+
+def print_report(result):
+    print(f'pages {result["pages"]} in {result["elapsed"]:.2f} seconds, '
+          f'{result["pages_per_second"] or 0:.2f} pages/sec, drained {result["drained"]}')
+    print(f'statuses {json.dumps(result["statuses"], sort_keys=True)}')
+    print('stage,count,p50,p90,p99,max')
+    for name, s in result['stages'].items():
+        print(','.join([name, str(s['count'])] + ['' if s[x] is None else f'{s[x]:.4f}' for x in ('p50', 'p90', 'p99', 'max')]))
+    print('process,count,peak_rss_kb_p50,peak_rss_kb_max')
+    for role, s in result['memory_kb'].items():
+        print(f'{role},{s["count"]},{s["p50"]},{s["max"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    synthetic.add_arguments(parser)
+    parser.add_argument('--spiders', default=2, type=int, help='spider processes')
+    parser.add_argument('--scanners', default=2, type=int, help='scanner processes')
+    parser.add_argument('--cleaners', default=1, type=int, help='cleaner processes')
+    parser.add_argument('--scanner-processes', default='0', type=str, help='parse processes per scanner, 0 or auto')
+    parser.add_argument('--controller-port', default=5100, type=int, help='port for the controller')
+    parser.add_argument('--blob-dir', default=None, type=str, help='local blob directory, temporary by default')
+    parser.add_argument('--timeout', default=600, type=float, help='seconds to wait for the crawl to finish')
+    parser.add_argument('--settle', default=5, type=float, help='seconds the queues must stay empty')
+    parser.add_argument('--json', action='store_true', default=False, help='print the report as json')
+    args = parser.parse_args()
+
+    blob_dir = args.blob_dir or tempfile.mkdtemp(prefix='term-project-bench-')
+    os.environ.setdefault('RABBITMQ_HOST', 'localhost')
+    os.environ.setdefault('REDIS_HOST', 'localhost')
+    os.environ['BLOB_DIR'] = blob_dir
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(ROOT, 'base'), env.get('PYTHONPATH')]))
+    env['CONTROLLER_PORT'] = str(args.controller_port)
+    env['SCANNER_PROCESSES'] = args.scanner_processes
+    env['NO_PROXY'] = '*'
+    # common reads its connection settings from the environment on import
+    import common  # noqa: F401
+
+    site = synthetic.from_arguments(args)
+    server = synthetic.serve(site)
+    log_dir = os.path.join(blob_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    print(f'logs and blobs in {blob_dir}', file=sys.stderr)
+    processes = start_services(args, env, log_dir)
+    memory = dict()
+    try:
+        controller = f'http://localhost:{args.controller_port}'
+        if not wait_for_controller(controller, 60):
+            print('controller did not start', file=sys.stderr)
+            sys.exit(1)
+        started = time.time()
+        response = requests.post(f'{controller}/api/url', json={'url': site.url(0)})
+        response.raise_for_status()
+        correlation = response.json()['correlation']
+        print(f'crawl {correlation} started at {site.url(0)}', file=sys.stderr)
+        drained = wait_for_drain(args.timeout, args.settle)
+        records = collect(correlation, blob_dir)
+        finished = max([r['completed'] for r in records if 'completed' in r], default=time.time())
+    finally:
+        memory = stop_services(processes)
+        server.shutdown()
+    result = report(args, site, records, started, finished, memory, drained)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+synthetic.py
+a local web site with a generated link graph for benchmarking
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SiteGraph:
+    """
+    A fixed random link graph spread over a number of loopback hosts,
+    every 127.0.0.x address is its own domain to the crawler
+    """
+
+    def __init__(self, pages=100, links=5, hosts=4, port=8100, page_size=16384, latency=0.05,
+                 jitter=0.0, error_rate=0.0, crawl_delay=0, disallow='/private/', seed=5273):
+        self.pages = pages
+        self.hosts = hosts
+        self.port = port
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.crawl_delay = crawl_delay
+        self.disallow = disallow
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.edges = {n: self.random.sample(range(pages), min(links, pages)) for n in range(pages)}
+        self.requests = 0
+        self.errors = 0
+
+    def url(self, page):
+        return f'http://127.0.0.{page % self.hosts + 1}:{self.port}/page/{page}.html'
+
+    def robots(self):
+        lines = ['User-agent: *', f'Crawl-delay: {self.crawl_delay}']
+        if self.disallow:
+            lines.append(f'Disallow: {self.disallow}')
+        return '\n'.join(lines) + '\n'
+
+    def page(self, page):
+        links = ''.join(f'<li><a href="{self.url(x)}">page {x}</a></li>\n' for x in self.edges[page])
+        body = f'<html><head><title>Page {page}</title></head><body><ul>\n{links}</ul>\n'
+        filler = max(0, self.page_size - len(body) - len('</body></html>') - len('<p></p>\n'))
+        return f'{body}<p>{"x" * filler}</p>\n</body></html>'
+
+    def should_fail(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+    def delay(self):
+        with self.lock:
+            wait = self.latency + self.random.uniform(0, self.jitter)
+        time.sleep(wait)
+
+
+def make_handler(site: SiteGraph):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_text(self, status, text, content_type='text/html', etag=None):
+            data = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/robots.txt':
+                self.send_text(200, site.robots(), 'text/plain')
+                return
+            site.delay()
+            try:
+                page = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+                if not self.path.startswith('/page/') or page not in site.edges:
+                    raise ValueError(self.path)
+            except ValueError:
+                self.send_text(404, '<html><head><title>Not Found</title></head></html>')
+                return
+            if site.should_fail():
+                self.send_text(500, '<html><head><title>Server Error</title></head></html>')
+                return
+            etag = f'"page-{page}-{site.page_size}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_text(200, site.page(page), etag=etag)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(site: SiteGraph):
+    """
+    Start the site on a background thread, returns the server
+    """
+    server = ThreadingHTTPServer(('', site.port), make_handler(site))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='synthetic', daemon=True)
+    thread.start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--pages', default=100, type=int, help='pages in the site graph')
+    parser.add_argument('--links', default=5, type=int, help='links on each page')
+    parser.add_argument('--hosts', default=4, type=int, help='loopback hosts (domains) to spread pages over')
+    parser.add_argument('--site-port', default=8100, type=int, help='port for the synthetic site')
+    parser.add_argument('--page-size', default=16384, type=int, help='page size in bytes')
+    parser.add_argument('--latency', default=0.05, type=float, help='seconds before each page is served')
+    parser.add_argument('--jitter', default=0.0, type=float, help='extra random seconds of latency')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='fraction of pages answered with a 500')
+    parser.add_argument('--crawl-delay', default=0, type=int, help='robots.txt crawl delay')
+    parser.add_argument('--disallow', default='/private/', type=str, help='robots.txt disallow rule')
+    parser.add_argument('--seed', default=5273, type=int, help='random seed for the graph')
+
+
+def from_arguments(args) -> SiteGraph:
+    return SiteGraph(pages=args.pages, links=args.links, hosts=args.hosts, port=args.site_port,
+                     page_size=args.page_size, latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, crawl_delay=args.crawl_delay, disallow=args.disallow,
+                     seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    site = from_arguments(args)
+    server = serve(site)
+    print(f'serving {site.pages} pages, start at {site.url(0)}', file=sys.stderr)
+    try:
+        while True:
+            time.sleep(60)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
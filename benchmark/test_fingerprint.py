@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+test_fingerprint.py
+near duplicate fingerprints of synthetic pages and how the scanner handles a
+match, needs the packages in base/requirements.txt, run with
+python3 -m unittest discover benchmark
+"""
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'base'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+import synthetic  # noqa: E402
+
+# the scanner waits for the broker on import
+sys.path.insert(0, os.path.join(ROOT, 'scanner'))
+with mock.patch.object(common, 'wait_for_connection', return_value=True):
+    import scanner  # noqa: E402
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_different_link_pages_are_not_near_duplicates(self):
+        site = synthetic.SiteGraph(pages=50, links=40)
+        first, second = common.simhash(site.page(0)), common.simhash(site.page(1))
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertGreater(common.hamming_distance(first, second), common.SIMHASH_DISTANCE)
+
+    def test_short_pages_are_not_fingerprinted(self):
+        site = synthetic.SiteGraph(pages=50, links=5)
+        self.assertIsNone(common.simhash(site.page(0)))
+
+    def test_near_duplicates_share_an_index_key(self):
+        words = ' '.join(f'word{x}' for x in range(200))
+        first = common.simhash(f'<html><body><p>{words}</p></body></html>')
+        second = common.simhash(f'<html><body><p>{words} changed</p></body></html>')
+        self.assertLessEqual(common.hamming_distance(first, second), common.SIMHASH_DISTANCE)
+        self.assertTrue(set(common.simhash_bands(first)) & set(common.simhash_bands(second)))
+
+
+class ScanDuplicateTest(unittest.TestCase):
+
+    def scan(self, kind):
+        earlier = {'identifier': 'earlier', 'title': 'Page 0', 'links': ['a', 'b']}
+        message = {'identifier': 'later', 'correlation': 'crawl', 'status': 'spider-crawled',
+                   'data': [{'type': 'scan', 'depth': 1, 'local': 'gs://bucket/html/later.html',
+                             'sha256': '00', 'simhash': '0' * 16}]}
+        extract = mock.Mock(side_effect=AssertionError('page parsed again'))
+        with mock.patch.object(scanner, 'find_duplicate', return_value=(kind, earlier)), \
+                mock.patch.object(scanner, 'add_spider_tasks') as add_spider_tasks, \
+                mock.patch.object(scanner, 'count_fingerprint'), \
+                mock.patch.object(scanner, 'add_cleanup_task') as add_cleanup_task, \
+                mock.patch.object(common, 'get_job_redis'):
+            scanner.scan_message(json.dumps(message), extract, retry=lambda: False)
+        extract.assert_not_called()
+        add_spider_tasks.assert_not_called()
+        return json.loads(add_cleanup_task.call_args[0][1])
+
+    def test_near_duplicate_reuses_the_earlier_page(self):
+        result = self.scan('near')
+        self.assertEqual(result['status'], 'scan-complete')
+        self.assertEqual(result['data'][-1]['data'], {'title': 'Page 0', 'links': ['a', 'b'],
+                                                      'duplicate': 'near', 'duplicate_of': 'earlier'})
+
+    def test_exact_duplicate_reuses_the_earlier_page(self):
+        self.assertEqual(self.scan('exact')['data'][-1]['data']['duplicate'], 'exact')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,30 +7,24 @@ gerhard van andel
 import json
 import socket
 import sys
-from datetime import datetime
 
-import pika
 import common
-from google.cloud import storage
 
 
-start_datetime = datetime.utcnow()
 logger = common.setup_logger(__name__)
+startup = common.StartupTimer(logger)
 
 if not common.wait_for_connection(logger):
     logger.error(' [*] failed to connect, exiting')
     sys.exit(1)
+startup.mark('broker')
 
 
 def upload_blob(bucket_name, source_data, destination_blob_name):
     """
     Uploads a file to the bucket
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_string(source_data, content_type='application/json')
+    common.upload_blob(bucket_name, source_data, destination_blob_name, 'application/json')
     logger.info(' [x] file {} uploaded to {}'.format(destination_blob_name, bucket_name))
 
 
@@ -57,10 +51,7 @@ def callback(ch, method, properties, body):
 def main():
     ip_addr = socket.gethostbyname(socket.gethostname())
     logger.info(' [*] ip address is: {}'.format(ip_addr))
-    logger.info(f' [*] startup time took, {(datetime.utcnow() - start_datetime).total_seconds()} seconds')
-
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
 
     channel.queue_declare(queue='cleanup_queue', durable=True)
@@ -68,6 +59,8 @@ def main():
     logger.info(' [*] waiting for messages. To exit press CTRL+C')
     channel.basic_qos(prefetch_count=1)
     channel.basic_consume(on_message_callback=callback, queue='cleanup_queue', consumer_tag=ip_addr)
+    startup.mark('consumer')
+    startup.report()
 
     try:
         channel.start_consuming()
@@ -6,11 +6,192 @@ gerhard van andel
 """
 
 import sys
+import math
 import json
+import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
 URL = 'localhost:5000'
+LOAD_TARGET = 'https://example.com/'
+ENDPOINTS = ('url', 'url_id', 'queues')
+TERMINAL = ('cleanup-complete', 'failed', 'limited', 'retries-exhausted')
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf'))
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """
+    One keep-alive session shared by every worker
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Pacer:
+    """
+    Hands out evenly spaced send times for a target request rate
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            slot = max(self.next, time.monotonic())
+            self.next = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LoadStats:
+    """
+    Latency and error counts per endpoint
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict()
+        self.errors = dict()
+        self.codes = dict()
+        self.identifiers = list()
+
+    def record(self, endpoint, elapsed, code=None, error=False):
+        with self.lock:
+            self.latencies.setdefault(endpoint, list()).append(elapsed)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + error
+            codes = self.codes.setdefault(endpoint, dict())
+            codes[code] = codes.get(code, 0) + 1
+
+    def add_identifier(self, identifier):
+        with self.lock:
+            self.identifiers.append(identifier)
+
+    def pick_identifier(self, n):
+        with self.lock:
+            return self.identifiers[n % len(self.identifiers)] if self.identifiers else None
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def send(session, base, endpoint, target, stats, n):
+    identifier = stats.pick_identifier(n) if endpoint == 'url_id' else None
+    if endpoint == 'url_id' and identifier is None:
+        endpoint = 'url'
+    start = time.monotonic()
+    try:
+        if endpoint == 'url':
+            response = session.post(f'{base}/api/url', json={'url': target})
+        elif endpoint == 'url_id':
+            response = session.get(f'{base}/api/url/{identifier}')
+        else:
+            response = session.get(f'{base}/api/queues')
+        elapsed = time.monotonic() - start
+        stats.record(endpoint, elapsed, response.status_code, response.status_code >= 400)
+        if endpoint == 'url' and response.status_code == 200:
+            stats.add_identifier(response.json()['identifier'])
+    except requests.exceptions.RequestException:
+        stats.record(endpoint, time.monotonic() - start, error=True)
+
+
+def run_load(args):
+    """
+    Drive the controller with concurrent workers at a target rate
+    """
+    endpoints = [x.strip() for x in args.endpoints.split(',') if x.strip()]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f'unknown endpoint {endpoint}, expected one of {",".join(ENDPOINTS)}')
+    base = f'http://{args.url}'
+    session = make_session(args.workers)
+    pacer = Pacer(args.rate)
+    stats = LoadStats()
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker():
+        while True:
+            pacer.wait()
+            if time.monotonic() >= deadline:
+                return
+            with counter_lock:
+                n = next(counter)
+            send(session, base, endpoints[n % len(endpoints)], args.load_target, stats, n)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for future in [executor.submit(worker) for _ in range(args.workers)]:
+            future.result()
+    elapsed = time.monotonic() - start
+    session.close()
+    print_load(stats, elapsed)
+
+
+def print_load(stats, elapsed):
+    total = sum(len(x) for x in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print(f'{total} requests in {elapsed:.2f} seconds, {total / elapsed:.2f} requests/sec, {errors} errors', file=sys.stderr)
+    print('endpoint,count,errors,error_rate,p50,p90,p99,max,codes')
+    for endpoint, latencies in stats.latencies.items():
+        codes = ' '.join(f'{k}:{v}' for k, v in sorted(stats.codes[endpoint].items(), key=lambda x: str(x[0])))
+        print('{},{},{},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{}'.format(
+            endpoint, len(latencies), stats.errors[endpoint], stats.errors[endpoint] / len(latencies),
+            percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), max(latencies), codes))
+    for endpoint, latencies in stats.latencies.items():
+        print(f'{endpoint} latency histogram', file=sys.stderr)
+        lower = 0
+        for upper in BUCKETS:
+            count = sum(1 for x in latencies if lower <= x < upper)
+            label = f'>= {lower * 1000:g}ms' if upper == float('inf') else f'< {upper * 1000:g}ms'
+            print(f'  {label:>10} {count:>7} {"#" * round(50 * count / len(latencies))}', file=sys.stderr)
+            lower = upper
+
+
+def run_watch(args):
+    """
+    Follow a crawl from its first identifier over one reused connection
+    """
+    base = f'http://{args.url}'
+    session = make_session(1)
+    statuses = {args.watch: None}
+    while True:
+        for identifier in [k for k, v in statuses.items() if v not in TERMINAL]:
+            response = session.get(f'{base}/api/url/{identifier}')
+            if response.status_code != 200:
+                continue
+            message = response.json()
+            status = message['status']
+            if status != statuses[identifier]:
+                url = next((x['url'] for x in message['data'] if x['type'] == 'spider'), '')
+                print(f'{time.strftime("%H:%M:%S")} {identifier} {status} {url}')
+                statuses[identifier] = status
+            for entry in message['data']:
+                if entry['type'] == 'scan' and 'data' in entry:
+                    for link in entry['data'].get('links', list()):
+                        statuses.setdefault(link, None)
+        counts = dict()
+        for status in statuses.values():
+            counts[status or 'unknown'] = counts.get(status or 'unknown', 0) + 1
+        print(f'{time.strftime("%H:%M:%S")} {len(statuses)} tasks {json.dumps(counts, sort_keys=True)}', file=sys.stderr)
+        if all(x in TERMINAL for x in statuses.values()):
+            break
+        time.sleep(args.interval)
+    session.close()
 
 
 def main():
@@ -22,9 +203,23 @@ def main():
     group.add_argument('--stats', action='store_true', default=False, help='stats')
     group.add_argument('--queues', action='store_true', default=False, help='queues')
     group.add_argument('--status', action='store_true', default=False, help='status')
+    group.add_argument('--load', action='store_true', default=False, help='generate load against the controller')
+    group.add_argument('--watch', type=str, metavar='UUID', help='follow the progress of a crawl')
+    parser.add_argument('--workers', default=8, type=int, help='load: concurrent workers')
+    parser.add_argument('--rate', default=0, type=float, help='load: target requests per second, 0 for unlimited')
+    parser.add_argument('--duration', default=10, type=float, help='load: seconds to run')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), type=str, help='load: comma separated endpoints to hit')
+    parser.add_argument('--load-target', default=LOAD_TARGET, type=str, help='load: url posted to /api/url')
+    parser.add_argument('--interval', default=2, type=float, help='watch: seconds between polls')
     args = parser.parse_args()
 
     try:
+        if args.load:
+            run_load(args)
+            return
+        if args.watch:
+            run_watch(args)
+            return
         if args.target:
             response = requests.post(f'http://{args.url}/api/url', json={'url': args.target})
         elif args.uuid:
@@ -4,32 +4,179 @@
 controller.py
 gerhard van andel
 """
+import os
 import sys
 import json
+import time
 import uuid
 import socket
-from datetime import datetime
+import argparse
+import threading
+from contextlib import contextmanager
 
 import pika
 import common
 from flask import Flask, request, Response
-from google.cloud import storage
-from google.cloud.exceptions import NotFound
 
-start_datetime = datetime.utcnow()
+PORT = int(os.environ.get('CONTROLLER_PORT', 5000))
+# 0 workers runs the flask development server
+WORKERS = int(os.environ.get('CONTROLLER_WORKERS', 0))
+THREADS = int(os.environ.get('CONTROLLER_THREADS', 1))
+QUEUE_NAMES = tuple(common.spider_shard_queues()) + ('scan_queue', 'cleanup_queue')
+QUEUE_REFRESH = float(os.environ.get('CONTROLLER_QUEUE_REFRESH', 1))
+QUEUE_STALENESS = float(os.environ.get('CONTROLLER_QUEUE_STALENESS', 5))
+BROKER_POOL_SIZE = int(os.environ.get('CONTROLLER_BROKER_POOL', 4))
+STATUS_TTL = float(os.environ.get('CONTROLLER_STATUS_TTL', 5))
+STATUS_FIELDS = (
+    'redis_version', 'uptime_in_seconds', 'connected_clients', 'blocked_clients',
+    'used_memory', 'used_memory_human', 'used_memory_peak_human', 'maxmemory', 'mem_fragmentation_ratio',
+    'total_connections_received', 'total_commands_processed', 'instantaneous_ops_per_sec',
+    'keyspace_hits', 'keyspace_misses', 'expired_keys', 'evicted_keys', 'rdb_last_save_time'
+)
+
 logger = common.setup_logger(__name__)
+startup = common.StartupTimer(logger)
 
 if not common.wait_for_connection(logger):
     logger.error(' [*] failed to connect, exiting')
     sys.exit(1)
+startup.mark('broker')
 
 ip_addr = socket.gethostbyname(socket.gethostname())
 logger.info(' [*] ip address is: {}'.format(ip_addr))
-logger.info(f' [*] startup time took, {(datetime.utcnow() - start_datetime).total_seconds()} seconds')
 
 # Initialize the Flask application
 app = Flask(__name__)
 app.logger = logger
+startup.mark('app')
+startup.report()
+
+broker_pool = {'pid': None, 'idle': list(), 'lock': threading.Lock()}
+queue_depths = {'pid': None, 'updated': 0, 'queues': list(), 'lock': threading.Lock()}
+redis_status = {'updated': 0, 'info': None, 'lock': threading.Lock()}
+
+
+def open_channel():
+    connection = common.get_rabbitmq_connection()
+    channel = connection.channel()
+    common.declare_spider_exchange(channel)
+    return connection, channel
+
+
+def close_quietly(connection):
+    try:
+        if connection.is_open:
+            connection.close()
+    except pika.exceptions.AMQPError:
+        pass
+
+
+@contextmanager
+def pooled_channel():
+    """
+    Borrow a broker channel from the pool of this worker process, a channel is
+    only handed to one thread at a time since pika connections are not thread safe
+    """
+    with broker_pool['lock']:
+        if broker_pool['pid'] != os.getpid():
+            broker_pool.update({'pid': os.getpid(), 'idle': list()})
+        entry = broker_pool['idle'].pop() if broker_pool['idle'] else None
+    if entry is not None:
+        try:
+            # services heartbeats and notices a closed socket before it is used
+            entry[0].process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as err:
+            logger.warning(f'* pooled broker connection lost {err}')
+            close_quietly(entry[0])
+            entry = None
+    if entry is not None and entry[1].is_closed:
+        # the broker can close a channel and leave its connection open
+        close_quietly(entry[0])
+        entry = None
+    if entry is None:
+        entry = open_channel()
+    healthy = False
+    try:
+        yield entry[1]
+        healthy = True
+    finally:
+        with broker_pool['lock']:
+            if healthy and entry[1].is_open and len(broker_pool['idle']) < BROKER_POOL_SIZE:
+                broker_pool['idle'].append(entry)
+                entry = None
+        if entry is not None:
+            close_quietly(entry[0])
+
+
+def publish_spider_task(message, domain):
+    for attempt in (1, 2):
+        try:
+            with pooled_channel() as channel:
+                common.publish_spider_task(channel, message, domain)
+            return
+        except pika.exceptions.AMQPError as err:
+            if attempt == 2:
+                raise err
+            logger.warning(f'* publish failed {err}, retrying on a new channel')
+
+
+def read_queue_depths(channel):
+    queues = list()
+    for queue_name in QUEUE_NAMES:
+        queue = channel.queue_declare(queue=queue_name, durable=True)
+        queues.append({'queue': queue_name, 'count': queue.method.message_count})
+    return queues
+
+
+def refresh_queue_depths():
+    """
+    Background thread keeping the queue depths of this worker up to date
+    """
+    connection = None
+    while True:
+        try:
+            if connection is None or connection.is_closed:
+                connection = common.get_rabbitmq_connection()
+                channel = connection.channel()
+            queues = read_queue_depths(channel)
+            queue_depths.update({'queues': queues, 'updated': time.monotonic()})
+            connection.sleep(QUEUE_REFRESH)
+        except Exception as err:
+            logger.warning(f'* queue refresh failed {err}')
+            connection = None
+            time.sleep(QUEUE_REFRESH)
+
+
+def get_queue_depths():
+    """
+    Queue depths from memory, read directly when the background copy is older
+    than QUEUE_STALENESS
+    """
+    with queue_depths['lock']:
+        if queue_depths['pid'] != os.getpid():
+            # threads do not survive a fork, start one in each worker
+            queue_depths['pid'] = os.getpid()
+            threading.Thread(target=refresh_queue_depths, name='queue-depths', daemon=True).start()
+    age = time.monotonic() - queue_depths['updated']
+    if age > QUEUE_STALENESS:
+        with pooled_channel() as channel:
+            queues = read_queue_depths(channel)
+        queue_depths.update({'queues': queues, 'updated': time.monotonic()})
+        age = 0
+    return queue_depths['queues'], age
+
+
+def get_redis_status():
+    """
+    A trimmed copy of redis info, cached for STATUS_TTL seconds
+    """
+    with redis_status['lock']:
+        if redis_status['info'] is None or time.monotonic() - redis_status['updated'] > STATUS_TTL:
+            info = common.get_stats_redis().info()
+            trimmed = {k: info[k] for k in STATUS_FIELDS if k in info}
+            trimmed.update({k: v for k, v in info.items() if k.startswith('db')})
+            redis_status.update({'info': trimmed, 'updated': time.monotonic()})
+        return redis_status['info']
 
 
 # route http get to this method
@@ -40,7 +187,7 @@ def get_status():
     """
     status = 200
     response = {
-        'redis': common.get_stats_redis().info()
+        'redis': get_redis_status()
     }
     json_response = json.dumps(response)
     return Response(response=json_response, status=status, mimetype="application/json")
@@ -49,10 +196,7 @@ def get_status():
 def download_blob(bucket_name, blob_name):
     """Downloads a blob from the bucket."""
     logger.info(' [x] pulling data from bucket {} blob {}'.format(bucket_name, blob_name))
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    source_data = blob.download_as_string()
+    source_data = common.download_blob(bucket_name, blob_name)
     logger.info(' [x] bucket {} blob {} downloaded len: {}'.format(bucket_name, blob_name, len(source_data)))
     return source_data
 
@@ -84,12 +228,7 @@ def url():
 def add_spider_task(task):
     """
     """
-    # Initialize the rabbitmq connection
     app.logger.info('* add task: {}'.format(task))
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
-    channel = connection.channel()
-    channel.queue_declare(queue='task_queue', durable=True)
     identifier = str(uuid.uuid4())
     app.logger.info('* task identifier generated: {}'.format(identifier))
     ret = {
@@ -100,17 +239,7 @@ def add_spider_task(task):
     }
     app.logger.info('* task generated: {}'.format(ret))
     message = json.dumps(ret)
-    channel.basic_publish(
-        exchange='',
-        routing_key='spider_queue',
-        properties=pika.BasicProperties(
-            content_type='application/json',
-            content_encoding='UTF-8',
-            delivery_mode=2
-        ),
-        body=message,
-    )
-    connection.close()
+    publish_spider_task(message, task['domain'])
     # Initialize the Redis connection
     common.get_job_redis().set(identifier, message)
     return ret
@@ -132,7 +261,7 @@ def get_url(identifier):
             response = download_blob(common.USER_BUCKET, f'data/{identifier}.json')
             status = 200
             response = json.loads(response)
-    except NotFound as err:
+    except common.BlobNotFound as err:
         app.logger.exception(err)
         response = {'type': 'error', 'error': 'not found', 'identifier': identifier}
         status = 404
@@ -145,6 +274,17 @@ def get_url(identifier):
     return Response(response=json_response, status=status, mimetype="application/json")
 
 
+def get_fingerprint_stats():
+    """
+    How many scanned pages were exact or near duplicates of an earlier page
+    """
+    counts = {k.decode(): int(v) for k, v in common.get_fingerprint_redis().hgetall('fingerprint.stats').items()}
+    scanned = sum(counts.values())
+    stats = {k: counts.get(k, 0) for k in ('unique', 'exact', 'near')}
+    stats['hit_rate'] = (stats['exact'] + stats['near']) / scanned if scanned else 0
+    return stats
+
+
 # route http get to this method
 @app.route('/api/stats', methods=['GET'], endpoint='get_stats')
 def get_stats():
@@ -162,6 +302,7 @@ def get_stats():
             point = json.loads(r.get(key))
             response['data'].append(point)
             response['total'] += 1
+        response['fingerprints'] = get_fingerprint_stats()
     except Exception as err:
         import traceback
         app.logger.exception(err)
@@ -180,17 +321,12 @@ def get_queues():
     """
     status = 200
     response = {'status': 'OK', 'queues': list(), 'total': 0}
-    app.logger.info('* get queues')
+    app.logger.debug('* get queues')
     try:
-        credentials = pika.PlainCredentials('guest', 'guest')
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
-        channel = connection.channel()
-        for queue_name in ('spider_queue', 'scan_queue', 'cleanup_queue'):
-            queue = channel.queue_declare(queue=queue_name, durable=True)
-            queue_count = queue.method.message_count
-            response['total'] += queue_count
-            response['queues'].append({'queue': queue_name, 'count': queue_count})
-        connection.close()
+        queues, age = get_queue_depths()
+        response['queues'] = queues
+        response['total'] = sum(x['count'] for x in queues)
+        response['age'] = round(age, 3)
     except Exception as err:
         app.logger.exception(err)
         import traceback
@@ -200,10 +336,36 @@ def get_queues():
     return Response(response=json_response, status=status, mimetype='application/json')
 
 
+def serve(workers, threads):
+    """
+    Serve the app with gunicorn, each worker keeps its own broker channels,
+    redis pool and queue depth cache
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'0.0.0.0:{PORT}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
 # start flask app
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=WORKERS, type=int, help='gunicorn workers, 0 for the flask development server')
+    parser.add_argument('--threads', default=THREADS, type=int, help='threads per gunicorn worker')
+    args = parser.parse_args()
     try:
-        app.run(host="0.0.0.0", port=5000)
+        if args.workers > 0:
+            serve(args.workers, args.threads)
+        else:
+            app.run(host="0.0.0.0", port=PORT)
     except KeyboardInterrupt:
         pass
     except Exception as error:
@@ -4,38 +4,56 @@
 scanner.py
 gerhard van andel
 """
+import os
 import json
 import socket
 import sys
 import uuid
+import threading
+import multiprocessing
 from datetime import datetime
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import pika
 import common
-from bs4 import BeautifulSoup
-from google.cloud import storage
 
 
-start_datetime = datetime.utcnow()
+FINGERPRINT_TTL = 86400
+# 0 parses in the consumer, auto uses a process per available core
+SCANNER_PROCESSES = os.environ.get('SCANNER_PROCESSES', '0')
+PREFETCH_PER_PROCESS = 2
+
 logger = common.setup_logger(__name__)
+startup = common.StartupTimer(logger)
 
 if not common.wait_for_connection(logger):
     logger.error(' [*] failed to connect, exiting')
     sys.exit(1)
+startup.mark('broker')
 
 
 def download_blob(bucket_name, blob_name):
     """Downloads a blob from the bucket."""
     logger.info(' [x] pulling data from bucket {} blob {}'.format(bucket_name, blob_name))
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    source_data = blob.download_as_string()
+    source_data = common.download_blob(bucket_name, blob_name)
     logger.info(' [x] bucket {} blob {} downloaded len: {}'.format(bucket_name, blob_name, len(source_data)))
     return source_data
 
 
-def parse_web_page(identifier, correlation, task):
+def extract_page(content):
+    """
+    The title and link hrefs of raw html, runs in a parse worker process
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    hrefs = [str(link['href']) for link in soup.find_all('a') if link.has_attr('href')]
+    title = soup.title.string
+    return {'title': str(title) if title is not None else None, 'hrefs': hrefs}
+
+
+def parse_web_page(identifier, correlation, task, extract=extract_page):
     """ lets get the links in the web page"""
     logger.info(' [x] {} BeautifulSoup start'.format(identifier))
     gs_local = task['local'].split('/', 3)
@@ -43,24 +61,113 @@ def parse_web_page(identifier, correlation, task):
     logger.info(' [x] {} bucket_name: {} blob: {}'.format(identifier, bucket_name, blob))
     content = download_blob(bucket_name, blob)
     logger.info(' [x] {} content received'.format(identifier))
-    soup = BeautifulSoup(content, 'html.parser')
-    logger.info(' [x] {} BeautifulSoup soup received'.format(identifier))
-    page = {'title': soup.title.string, 'links': list()}
-    logger.info(' [x] {} url {} received'.format(identifier, soup.title.string))
-    for link in soup.find_all('a'):
+    page = extract(content)
+    logger.info(' [x] {} url {} received'.format(identifier, page['title']))
+    page['links'] = make_link_tasks(identifier, correlation, task, page['hrefs'])
+    logger.info(' [x] {} BeautifulSoup complete'.format(identifier))
+    return page
+
+
+def make_link_tasks(identifier, correlation, task, hrefs):
+    """
+    Spider tasks for the links of a page not yet seen in this crawl
+    """
+    links = list()
+    for href in hrefs:
         try:
-            task = common.make_spider_task(link['href'], task['depth'])
-            h = common.domain_hash(correlation, task['url'])
+            link_task = common.make_spider_task(href, task['depth'])
+            h = common.domain_hash(correlation, link_task['url'])
             if common.get_domain_redis().get(h):
-                logger.info(' [x] {} {} has already seen url {} skipping'.format(identifier, correlation, task['url']))
+                logger.info(' [x] {} {} has already seen url {} skipping'.format(identifier, correlation, link_task['url']))
                 continue
-            task['identifier'] = str(uuid.uuid4())
-            logger.info(' [x] {} task made for url: {}'.format(identifier, link['href']))
-            page['links'].append(task)
-        except (ValueError, KeyError, StopIteration):
-            logger.debug(' [x] {} skipping {}'.format(identifier, link))
-    logger.info(' [x] {} BeautifulSoup complete'.format(identifier))
-    return page
+            link_task['identifier'] = str(uuid.uuid4())
+            logger.info(' [x] {} task made for url: {}'.format(identifier, href))
+            links.append(link_task)
+        except (ValueError, StopIteration):
+            logger.debug(' [x] {} skipping {}'.format(identifier, href))
+    return links
+
+
+def reuse_web_page(identifier, correlation, task):
+    """
+    The parse result of the last fetch when the page has not changed since
+    """
+    record = common.get_fetch_record(task['url'])
+    if record is None or 'page' not in record or record.get('local') != task['local']:
+        return None
+    logger.info(' [x] {} {} not modified, reusing parse result'.format(identifier, task['url']))
+    page = record['page']
+    return {'title': page['title'], 'hrefs': page['hrefs'],
+            'links': make_link_tasks(identifier, correlation, task, page['hrefs'])}
+
+
+def save_web_page(task, page):
+    """
+    Keep the parse result with the fetch record so a recrawl can reuse it
+    """
+    if 'url' not in task:
+        return
+    record = common.get_fetch_record(task['url'])
+    if record is None or record.get('local') != task['local']:
+        return
+    record['page'] = {'title': page['title'], 'hrefs': page['hrefs']}
+    common.set_fetch_record(task['url'], record)
+
+
+def find_duplicate(identifier, correlation, task):
+    """
+    Look for an earlier page of the crawl with the same or nearly the same
+    content, returns the kind of match and the earlier parse result
+    """
+    if 'sha256' not in task:
+        return None, None
+    r = common.get_fingerprint_redis()
+    earlier = r.get(f'fingerprint.{correlation}.sha256.{task["sha256"]}')
+    if earlier is not None:
+        page = r.get(f'fingerprint.{correlation}.page.{earlier.decode()}')
+        if page is not None:
+            return 'exact', json.loads(page)
+    if task.get('simhash') is None:
+        return None, None
+    value = int(task['simhash'], 16)
+    pipe = r.pipeline()
+    for key in common.simhash_bands(value):
+        pipe.smembers(f'fingerprint.{correlation}.simhash.{key}')
+    candidates = set().union(*pipe.execute())
+    for candidate in candidates:
+        other, earlier = candidate.decode().split(':')
+        if common.hamming_distance(value, int(other, 16)) <= common.SIMHASH_DISTANCE:
+            page = r.get(f'fingerprint.{correlation}.page.{earlier}')
+            if page is not None:
+                logger.info(f' [x] {identifier} near duplicate of {earlier}')
+                return 'near', json.loads(page)
+    return None, None
+
+
+def index_page(identifier, correlation, task, page):
+    """
+    Remember the fingerprints and parse result of a page for the rest of the crawl
+    """
+    if 'sha256' not in task:
+        return
+    pipe = common.get_fingerprint_redis().pipeline()
+    key = f'fingerprint.{correlation}.page.{identifier}'
+    pipe.set(key, json.dumps({'identifier': identifier, 'title': page['title'], 'links': page['links']}), ex=FINGERPRINT_TTL)
+    pipe.set(f'fingerprint.{correlation}.sha256.{task["sha256"]}', identifier, ex=FINGERPRINT_TTL, nx=True)
+    if task.get('simhash') is not None:
+        for value in common.simhash_bands(int(task['simhash'], 16)):
+            band_key = f'fingerprint.{correlation}.simhash.{value}'
+            pipe.sadd(band_key, f'{task["simhash"]}:{identifier}')
+            pipe.expire(band_key, FINGERPRINT_TTL)
+    pipe.execute()
+
+
+def count_fingerprint(correlation, kind):
+    pipe = common.get_fingerprint_redis().pipeline()
+    pipe.hincrby('fingerprint.stats', kind, 1)
+    pipe.hincrby(f'fingerprint.{correlation}.stats', kind, 1)
+    pipe.expire(f'fingerprint.{correlation}.stats', FINGERPRINT_TTL)
+    pipe.execute()
 
 
 def add_spider_tasks(correlation, task_list):
@@ -68,10 +175,8 @@ def add_spider_tasks(correlation, task_list):
     """
     ret = list()
     # Initialize the rabbitmq connection
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
-    channel.queue_declare(queue='task_queue', durable=True)
     for task in task_list:
         logger.info(f' [x] add task: {task}')
         identifier = task['identifier']
@@ -84,16 +189,7 @@ def add_spider_tasks(correlation, task_list):
         }
         logger.info(f' [x] task generated: {spider_task}')
         message = json.dumps(spider_task)
-        channel.basic_publish(
-            exchange='',
-            routing_key='spider_queue',
-            properties=pika.BasicProperties(
-                content_type='application/json',
-                content_encoding='UTF-8',
-                delivery_mode=2
-            ),
-            body=message,
-        )
+        common.publish_spider_task(channel, message, task['domain'])
         # Initialize the Redis connection
         common.get_job_redis().set(identifier, message)
         ret.append(identifier)
@@ -107,8 +203,7 @@ def add_cleanup_task(identifier, message):
     """
     """
     logger.info(' [x] {} establishing connection to rabbitmq'.format(identifier))
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
     logger.info(' [x] {} message to cleanup queue'.format(identifier))
     channel.basic_publish(
@@ -125,7 +220,11 @@ def add_cleanup_task(identifier, message):
     logger.info(' [x] {} added message to cleanup queue complete'.format(identifier))
 
 
-def callback(ch, method, properties, body):
+def scan_message(body, extract, retry):
+    """
+    Scan the page of a message and hand it to the cleaner, retry is called
+    on transient errors and returns False once retries are used up
+    """
     logger.info(' [x] message received')
     message = json.loads(body)
     identifier = message['identifier']
@@ -135,18 +234,37 @@ def callback(ch, method, properties, body):
     try:
         task = [x for x in message['data'] if x['type'] == 'scan'][0]
         logger.info(' [x] {} url depth {} received'.format(identifier, task['depth']))
-        parsed_data = parse_web_page(identifier, correlation, task)
-        links = parsed_data.pop('links')
-        logger.info(f' [x] {identifier} web information parsed now making {len(links)} tasks')
-        parsed_data['links'] = add_spider_tasks(correlation, links)
+        kind, earlier = find_duplicate(identifier, correlation, task)
+        if earlier is not None:
+            logger.info(f' [x] {identifier} {kind} duplicate of {earlier["identifier"]}, links not queued again')
+            parsed_data = {'title': earlier['title'], 'links': earlier['links'],
+                           'duplicate': kind, 'duplicate_of': earlier['identifier']}
+        else:
+            parsed_data = reuse_web_page(identifier, correlation, task) if task.get('not_modified') else None
+            if parsed_data is None:
+                parsed_data = parse_web_page(identifier, correlation, task, extract)
+                save_web_page(task, parsed_data)
+            parsed_data.pop('hrefs')
+            links = parsed_data.pop('links')
+            logger.info(f' [x] {identifier} web information parsed now making {len(links)} tasks')
+            parsed_data['links'] = add_spider_tasks(correlation, links)
+            index_page(identifier, correlation, task, parsed_data)
+        count_fingerprint(correlation, kind or 'unique')
         results.update({'type': 'scan', 'data': parsed_data})
         status = 'scan-complete'
     except Exception as err:
         import traceback
         logger.exception(err)
-        logger.error(f' [x] {identifier} failed')
+        if common.is_transient_error(err):
+            if retry():
+                logger.info(f' [x] {identifier} retry scheduled')
+                return
+            logger.error(f' [x] {identifier} retries exhausted')
+            status = 'retries-exhausted'
+        else:
+            logger.error(f' [x] {identifier} failed')
+            status = 'failed'
         results = {'type': 'error', 'error': traceback.format_exc().splitlines()[-1]}
-        status = 'failed'
     results['timestamp'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
     message['data'].append(results)
     message['status'] = status
@@ -159,28 +277,131 @@ def callback(ch, method, properties, body):
         logger.error(' [x] {} failed to make cleanup task {}'.format(message['identifier'], str(err)))
     else:
         logger.info(' [x] {} cleanup request complete'.format(message['identifier']))
+
+
+def callback(ch, method, properties, body):
+    scan_message(body, extract_page, lambda: common.publish_retry(ch, 'scan_queue', body, properties))
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
+def warm_up(_):
+    from bs4 import BeautifulSoup  # noqa: F401
+    return os.getpid()
+
+
+class ParallelScanner:
+    """
+    Parses pages in a process pool while threads of the consumer process do the
+    blob downloads, redis and publishing. In flight messages are bounded by the
+    consumer prefetch, only the broker connection thread touches the channel.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.prefetch = processes * PREFETCH_PER_PROCESS
+        self.lock = threading.Lock()
+        # forked workers skip importing this module again, they are started
+        # before any broker or redis connection exists to be inherited, a
+        # restarted pool inherits them but its workers only parse
+        self.parsers = self.start_parsers()
+        self.workers = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='scan')
+        self.connection = None
+
+    def start_parsers(self):
+        parsers = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('fork'))
+        pids = set(parsers.map(warm_up, range(self.processes)))
+        logger.info(f' [*] {len(pids)} parse processes started')
+        return parsers
+
+    def restart_parsers(self, broken):
+        """
+        Replace a pool that lost a process, every later submit to it would fail
+        """
+        with self.lock:
+            if self.parsers is not broken:
+                return
+            logger.error(' [*] a parse process died, restarting the pool')
+            broken.shutdown(wait=False)
+            self.parsers = self.start_parsers()
+
+    def on_connection(self, fn):
+        """
+        Run fn on the broker connection thread and wait for its result
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn())
+            except Exception as err:
+                future.set_exception(err)
+        self.connection.add_callback_threadsafe(run)
+        return future.result()
+
+    def extract(self, content):
+        parsers = self.parsers
+        try:
+            return parsers.submit(extract_page, content).result()
+        except BrokenProcessPool:
+            # the message is retried, a page that keeps killing its parse
+            # process ends up retries-exhausted
+            self.restart_parsers(parsers)
+            raise
+
+    def scan(self, ch, method, properties, body):
+        try:
+            scan_message(body, self.extract,
+                         lambda: self.on_connection(lambda: common.publish_retry(ch, 'scan_queue', body, properties)))
+        except Exception as err:
+            logger.exception(err)
+        self.connection.add_callback_threadsafe(partial(ch.basic_ack, delivery_tag=method.delivery_tag))
+
+    def callback(self, ch, method, properties, body):
+        self.workers.submit(self.scan, ch, method, properties, body)
+
+    def shutdown(self):
+        # unacked messages go back to the queue when the connection closes
+        self.workers.shutdown(wait=False)
+        self.parsers.shutdown(wait=False)
+
+
+def parse_processes():
+    if SCANNER_PROCESSES == 'auto':
+        return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    return int(SCANNER_PROCESSES)
+
+
 def main():
     ip_addr = socket.gethostbyname(socket.gethostname())
     logger.info(' [*] ip address is: {}'.format(ip_addr))
-    logger.info(f' [*] startup time took, {(datetime.utcnow() - start_datetime).total_seconds()} seconds')
-
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    processes = parse_processes()
+    scanner = ParallelScanner(processes) if processes > 0 else None
+    if scanner is not None:
+        startup.mark('parsers')
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
 
     channel.queue_declare(queue='scan_queue', durable=True)
+    common.declare_retry_queues(channel, 'scan_queue')
+    common.declare_spider_exchange(channel)
 
     logger.info(' [*] waiting for messages. To exit press CTRL+C')
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(on_message_callback=callback, queue='scan_queue', consumer_tag=ip_addr)
+    if scanner is not None:
+        scanner.connection = connection
+        channel.basic_qos(prefetch_count=scanner.prefetch)
+        channel.basic_consume(on_message_callback=scanner.callback, queue='scan_queue', consumer_tag=ip_addr)
+    else:
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(on_message_callback=callback, queue='scan_queue', consumer_tag=ip_addr)
+    startup.mark('consumer')
+    startup.report()
 
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         channel.stop_consuming()
+    if scanner is not None:
+        scanner.shutdown()
     connection.close()
 
 
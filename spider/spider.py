@@ -4,25 +4,27 @@
 spider.py
 gerhard van andel
 """
+import os
 import sys
 import json
 import socket
 import time
+import threading
 from datetime import datetime
-from random import randint
+from urllib.parse import urlparse
 from urllib.robotparser import RobotFileParser
 
 import pika
 import requests
 import common
-from google.cloud import storage
 
-start_datetime = datetime.utcnow()
 logger = common.setup_logger(__name__)
+startup = common.StartupTimer(logger)
 
 if not common.wait_for_connection(logger):
     logger.error(' [*] failed to connect, exiting')
     sys.exit(1)
+startup.mark('broker')
 
 
 USER_AGENT = f'asynchronousgillz, 1.1; requests, {requests.__version__};'
@@ -31,17 +33,32 @@ USER_DEPTH = 1
 MAX_DEPTH = 5
 MAX_PULL_COUNT = 20
 BT_INSTANCE = 'term-project-test-west-1'
+MEMBERS_KEY = 'spider.members'
+MEMBER_INTERVAL = 5
+MEMBER_TTL = 15
+# well under MEMBER_TTL, a stuck fetch holds up the message callbacks
+FETCH_TIMEOUT = 5
+# queues from before the spider exchange, drained into it on start up
+LEGACY_QUEUES = ['spider_queue.retry.{}s'.format(x) for x in (1, 5, 30, 120)] + ['spider_queue']
+
+# a domain only hashes to shards this spider owns, so politeness is local state
+next_fetch = dict()
+
+
+class CrawlDelayed(Exception):
+    """
+    The domain is still inside its crawl delay
+    """
+    def __init__(self, message, wait):
+        super().__init__(message)
+        self.wait = wait
 
 
 def upload_blob(bucket_name, source_data, destination_blob_name):
     """
     Uploads a file to the bucket
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_string(source_data, content_type='text/html')
+    common.upload_blob(bucket_name, source_data, destination_blob_name, 'text/html')
     logger.info(' [x] file {} uploaded to {}'.format(destination_blob_name, bucket_name))
 
 
@@ -62,7 +79,6 @@ def check_robots(identifier, task):
         domain_data = {
             'domain': task['domain'],
             'valid_url': valid_url,
-            'lock': False,
             'crawl_delay': USER_DELAY if delay is None else delay,
             'depth': USER_DEPTH
         }
@@ -75,21 +91,23 @@ def check_robots(identifier, task):
     return domain_data
 
 
-def pull_data(identifier, correlation, task, domain_data):
+def pull_data(identifier, correlation, task, domain_data, record=None):
     """
-    Pull the html data
+    Pull the html data, conditional on the last fetch when there is a record of it
     """
     domain = domain_data['domain']
-    domain_data = json.loads(common.get_domain_redis().get(domain))
-    if not domain_data or domain_data['lock']:
-        raise ResourceWarning(f'{identifier} lock unavailable for domain {domain}, skipping')
-    domain_data['lock'] = True
-    common.get_domain_redis().set(domain, json.dumps(domain_data), ex=120)
-    logger.info(' [x] {} lock acquired for domain {}'.format(identifier, domain_data['domain']))
+    wait = next_fetch.get(domain, 0) - time.monotonic()
+    if wait > 0:
+        raise CrawlDelayed(f'{identifier} crawl delay for domain {domain}, {wait:.3f} seconds left', wait)
     response = None
     try:
+        headers = {'user-agent': USER_AGENT}
+        if record is not None and record.get('etag'):
+            headers['if-none-match'] = record['etag']
+        if record is not None and record.get('last_modified'):
+            headers['if-modified-since'] = record['last_modified']
         logger.info(' [x] {} GET {}'.format(identifier, task['url']))
-        response = requests.get(task['url'], headers={'user-agent': USER_AGENT})
+        response = requests.get(task['url'], headers=headers, timeout=FETCH_TIMEOUT)
         if response.status_code < 500:
             h = common.domain_hash(correlation, task['url'])
             common.get_domain_redis().set(h, identifier)
@@ -99,14 +117,11 @@ def pull_data(identifier, correlation, task, domain_data):
         logger.error(' [x] {} {} {}'.format(identifier, task['url'], err))
         raise err
     finally:
-        logger.info(' [x] {} {} {} {} {}'.format(identifier, task['url'], response.request.method, response.status_code, response.elapsed.total_seconds()))
-        logger.debug(' [x] {} {} {}'.format(identifier, task['url'], response.text))
-        logger.info(' [x] {} lock sleep {} seconds for domain {}'.format(identifier, domain_data['crawl_delay'], domain_data['domain']))
-        time.sleep(domain_data['crawl_delay'])
-        domain_data['lock'] = False
-        common.get_domain_redis().set(domain, json.dumps(domain_data), ex=120)
-        logger.debug(' [x] {} {} {}'.format(identifier, task['url'], response.text))
-        logger.info(' [x] {} lock released for domain {}'.format(identifier, domain_data['domain']))
+        if response is not None:
+            logger.info(' [x] {} {} {} {} {}'.format(identifier, task['url'], response.request.method, response.status_code, response.elapsed.total_seconds()))
+            logger.debug(' [x] {} {} {}'.format(identifier, task['url'], response.text))
+        logger.info(' [x] {} next fetch in {} seconds for domain {}'.format(identifier, domain_data['crawl_delay'], domain))
+        next_fetch[domain] = time.monotonic() + domain_data['crawl_delay']
     return response
 
 
@@ -115,8 +130,7 @@ def make_scan_task(identifier, message):
     Add a task to scan the data
     """
     logger.info(' [x] {} establishing connection to rabbitmq'.format(identifier))
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
     logger.info(' [x] {} message to scan queue'.format(identifier))
     channel.basic_publish(
@@ -157,15 +171,45 @@ def callback(ch, method, properties, body):
             raise StopIteration('depth: {} > {}'.format(task['depth'], MAX_DEPTH))
         domain_data = check_robots(identifier, task)
         status = 'spider-crawled'
-        response = pull_data(identifier, correlation, task, domain_data)
-        blob_name = 'html/{}.html'.format(identifier)
-        upload_blob(common.USER_BUCKET, response.text, blob_name)
+        record = common.get_fetch_record(task['url'])
+        if record is not None and 'local' not in record:
+            record = None
+        response = pull_data(identifier, correlation, task, domain_data, record)
+        if response.status_code == 304 and record is not None:
+            logger.info(' [x] {} {} not modified, reusing {}'.format(identifier, task['url'], record['local']))
+            not_modified = True
+        else:
+            sha256 = common.content_hash(response.content)
+            not_modified = record is not None and record.get('sha256') == sha256
+        if not_modified:
+            local = record['local']
+            record.update({'etag': response.headers.get('etag', record.get('etag')),
+                           'last_modified': response.headers.get('last-modified', record.get('last_modified'))})
+        else:
+            blob_name = 'html/{}.html'.format(identifier)
+            upload_blob(common.USER_BUCKET, response.text, blob_name)
+            local = 'gs://{}/{}'.format(common.USER_BUCKET, blob_name)
+            fingerprint = common.simhash(response.text)
+            record = {
+                'url': task['url'],
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+                'sha256': sha256,
+                'simhash': format(fingerprint, '016x') if fingerprint is not None else None,
+                'local': local
+            }
+        record['fetched'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        common.set_fetch_record(task['url'], record)
         data_message = {
             'method': response.request.method,
             'code': response.status_code,
             'time': response.elapsed.total_seconds(),
-            'local': 'gs://{}/{}'.format(common.USER_BUCKET, blob_name),
+            'local': local,
             'depth': domain_data['depth'] + 1,
+            'url': task['url'],
+            'sha256': record['sha256'],
+            'simhash': record.get('simhash'),
+            'not_modified': not_modified,
             'type': 'scan'
         }
         query_data_key = 'domain.{}.{}'.format(domain_data['domain'], identifier)
@@ -177,10 +221,11 @@ def callback(ch, method, properties, body):
         common.get_stats_redis().set(query_data_key, json.dumps(response_data))
         results.update(data_message)
         valid_scan_task = True
-    except ResourceWarning as err:
+    except CrawlDelayed as err:
         logger.info(f' [x] {err}')
-        time.sleep(randint(1, task['depth']) ** 2)
-        ch.basic_reject(delivery_tag=method.delivery_tag)
+        tier = common.publish_delayed(ch, common.SPIDER_EXCHANGE, body, err.wait, properties.headers)
+        logger.info(f' [x] {identifier} deferred for {tier} seconds')
+        ch.basic_ack(delivery_tag=method.delivery_tag)
         return
     except StopIteration as err:
         logger.info(' [x] {} depth limited {}'.format(message['identifier'], str(err)))
@@ -189,8 +234,16 @@ def callback(ch, method, properties, body):
     except Exception as err:
         import traceback
         logger.exception(err)
-        logger.error(' [x] {} failed to read web page'.format(message['identifier']))
-        status = 'failed'
+        if common.is_transient_error(err):
+            if common.publish_retry(ch, common.SPIDER_EXCHANGE, body, properties):
+                logger.info(f' [x] {identifier} retry {common.get_retry_count(properties) + 1} scheduled')
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            logger.error(f' [x] {identifier} retries exhausted')
+            status = 'retries-exhausted'
+        else:
+            logger.error(' [x] {} failed to read web page'.format(message['identifier']))
+            status = 'failed'
         results.update({'type': 'error', 'error': traceback.format_exc().splitlines()[-1]})
     message['data'].append(results)
     message['status'] = status
@@ -206,23 +259,106 @@ def callback(ch, method, properties, body):
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
+def heartbeat(member, stop):
+    """
+    Keep this spider in the members set from its own thread, so a long message
+    callback does not let the other spiders take its shards
+    """
+    while not stop.wait(MEMBER_INTERVAL):
+        try:
+            common.get_domain_redis().zadd(MEMBERS_KEY, {member: time.time()})
+        except Exception as err:
+            logger.exception(err)
+
+
+def live_members():
+    """
+    Every spider that sent a heartbeat within MEMBER_TTL
+    """
+    pipe = common.get_domain_redis().pipeline()
+    pipe.zremrangebyscore(MEMBERS_KEY, 0, time.time() - MEMBER_TTL)
+    pipe.zrange(MEMBERS_KEY, 0, -1)
+    return sorted(x.decode() for x in pipe.execute()[-1])
+
+
+def drain_legacy_queues(connection):
+    """
+    Move messages left in the queues from before the spider exchange onto the
+    exchange, then delete the queues once they are empty
+    """
+    for queue in LEGACY_QUEUES:
+        channel = connection.channel()
+        try:
+            channel.queue_declare(queue=queue, passive=True)
+        except pika.exceptions.ChannelClosedByBroker:
+            continue
+        moved = 0
+        while True:
+            method, properties, body = channel.basic_get(queue=queue)
+            if method is None:
+                break
+            task = [x for x in json.loads(body)['data'] if x['type'] == 'spider'][0]
+            domain = task.get('domain') or urlparse(task['url']).netloc
+            common.publish_spider_task(channel, body, domain, properties.headers)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            moved += 1
+        logger.info(f' [*] moved {moved} messages from {queue} to {common.SPIDER_EXCHANGE}')
+        try:
+            channel.queue_delete(queue=queue, if_empty=True)
+            channel.close()
+        except pika.exceptions.ChannelClosedByBroker as err:
+            logger.info(f' [*] {queue} not deleted, {err}')
+
+
+def rebalance(connection, channel, member, consumers):
+    """
+    Consume from the shards this spider owns, cancel the ones it lost
+    """
+    try:
+        owned = set(common.owned_shards(member, live_members()))
+        for shard in sorted(set(consumers) - owned):
+            logger.info(f' [*] {member} releasing shard {shard}')
+            channel.basic_cancel(consumers.pop(shard))
+        for shard in sorted(owned - set(consumers)):
+            logger.info(f' [*] {member} taking shard {shard}')
+            consumers[shard] = channel.basic_consume(
+                on_message_callback=callback, queue=common.spider_shard_queue(shard), consumer_tag=f'{member}.{shard}')
+        now = time.monotonic()
+        for domain in [k for k, v in next_fetch.items() if v < now]:
+            del next_fetch[domain]
+    except Exception as err:
+        logger.exception(err)
+    connection.call_later(MEMBER_INTERVAL, lambda: rebalance(connection, channel, member, consumers))
+
+
 def main():
     ip_addr = socket.gethostbyname(socket.gethostname())
     logger.info(f' [*] ip address is: {ip_addr}')
-    logger.info(f' [*] startup time took, {(datetime.utcnow() - start_datetime).total_seconds()} seconds')
-
-    credentials = pika.PlainCredentials('guest', 'guest')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq', credentials=credentials))
+    member = f'{socket.gethostname()}.{os.getpid()}'
+    connection = common.get_rabbitmq_connection()
     channel = connection.channel()
-    channel.queue_declare(queue='spider_queue', durable=True)
+    common.declare_spider_exchange(channel)
+    drain_legacy_queues(connection)
+    common.get_domain_redis().zadd(MEMBERS_KEY, {member: time.time()})
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(member, stop), name='heartbeat', daemon=True).start()
 
     logger.info(' [*] waiting for messages. To exit press CTRL+C')
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(on_message_callback=callback, queue='spider_queue', consumer_tag=ip_addr)
+    # one message in flight across every shard consumer of the channel
+    channel.basic_qos(prefetch_count=1, global_qos=True)
+    consumers = dict()
+    rebalance(connection, channel, member, consumers)
+    startup.mark('consumer')
+    startup.report()
     try:
-        channel.start_consuming()
+        # start_consuming returns once no consumers are left, a spider may own no shards for a while
+        while True:
+            connection.process_data_events(time_limit=None)
     except KeyboardInterrupt:
-        channel.stop_consuming()
+        pass
+    finally:
+        stop.set()
+        common.get_domain_redis().zrem(MEMBERS_KEY, member)
     connection.close()
 
 